@@ -11,30 +11,44 @@ Key changes vs v3:
 """
 
 from __future__ import annotations
+import asyncio
 import base64
 import datetime as dt
+import hashlib
 import html
-import json
 import os
 import re
-import textwrap
+import shelve
+import string
+import tempfile
+import threading
 import time
+from concurrent.futures import ThreadPoolExecutor
+from email import policy
 from email.mime.multipart import MIMEMultipart
 from email.mime.text import MIMEText
-from email.utils import parseaddr
+from email.parser import BytesParser
+from email.utils import parseaddr, parsedate_to_datetime
 from typing import Dict, List, Tuple, Any
 
-import openai
-openai.api_key = os.getenv("OPENAI_API_KEY")
-
+# openai, googleapiclient.discovery and notion_client are imported lazily
+# inside the functions that use them — together they cost ~300ms of import
+# time, which is wasted when the script exits early (e.g. no TOKEN_JSON).
 from google.oauth2.credentials import Credentials
 from google.auth.transport.requests import Request
 from google_auth_oauthlib.flow import InstalledAppFlow
-from googleapiclient.discovery import build
 from googleapiclient.errors import HttpError
 from google.auth.exceptions import RefreshError
 
-from notion_client import Client
+try:
+    from lxml import html as lxml_html   # optional: C-based tag stripping
+except ImportError:
+    lxml_html = None
+
+try:
+    import orjson as _json   # optional: C JSON decoder for the token blobs
+except ImportError:
+    import json as _json
 
 # ─── CONFIG ──────────────────────────────────────────────────────────────
 CLIENT_ID: str     = os.getenv("GMAIL_CLIENT_ID", "").strip()
@@ -44,6 +58,7 @@ SEND_TO: str       = os.getenv("SEND_TO", "thiago.oliveira77@gmail.com").strip()
 MODEL           = "gpt-4o"
 SUMMARY_TOKENS  = 120
 CHUNK_SIZE      = 1900          # Notion block limit ≈2 k
+BODY_CHAR_BUDGET = 4800         # ≈4× the summariser prompt width; stop decoding past this
 WINDOW_SECONDS  = 24 * 3600
 
 NOTION_SECRET = os.getenv("NOTION_SECRET", "").strip()
@@ -69,9 +84,10 @@ CATEGORY_RULES: List[Tuple[str, re.Pattern[str]]] = [
     ("Newsletters", re.compile(r"(mckinsey\.com|emails?\.hbr\.org|hbr\.org|@interactive\.wsj\.com"
                                r"|newsletter|weekly digest|digest update)", re.I)),
     ("Work", re.compile(r"@arcelormittal", re.I)),   # ONLY ArcelorMittal
-    ("Personal", re.compile(r"", re.I)),             # fallback
-    ("Other", re.compile(r".*", re.S)),
 ]
+# Anything no rule matches falls through to this (the old always-matching
+# ("Personal", r"") entry meant "Other" was unreachable anyway).
+DEFAULT_CATEGORY = "Personal"
 
 # ─── FOLLOW-UP PATTERNS ──────────────────────────────────────────────────
 NEED_ACTION_PATTERNS: List[Tuple[str, re.Pattern[str]]] = [
@@ -82,13 +98,135 @@ NEED_ACTION_PATTERNS: List[Tuple[str, re.Pattern[str]]] = [
     ("Confirm attendance",re.compile(r"(rsvp|confirm).+?(attendance|presence)", re.I)),
 ]
 
+# ─── SHARED REGEXES (compiled once, reused per message) ──────────────────
+_TAG_RE     = re.compile(r"<[^>]+>")
+_RE_PREFIX  = re.compile(r"^re:\s", re.I)
+_NON_WORD   = re.compile(r"\W+")
+_HEADING_RE = re.compile(r"^[📊📝📎🤖]|^[A-Z][a-z]+")   # Notion heading lines
+
+# All category rules fused into one alternation so categorise() does a
+# single scan instead of one per rule. Group names are the category names
+# with non-word chars collapsed. A bare search() would resolve by leftmost
+# match position, not rule order, so callers pick the best hit from
+# finditer() via _GROUP_PRIO to keep first-rule-wins semantics.
+CAT_UNION = re.compile(
+    "|".join(f"(?P<{_NON_WORD.sub('_', cat)}>{pat.pattern})" for cat, pat in CATEGORY_RULES),
+    re.I,
+)
+_GROUP_TO_CAT = {_NON_WORD.sub("_", cat): cat for cat, _ in CATEGORY_RULES}
+_GROUP_PRIO = {_NON_WORD.sub("_", cat): i for i, (cat, _) in enumerate(CATEGORY_RULES)}
+
+# Boolean prefilter for the follow-up patterns: one fused scan decides
+# whether any action matches at all (the common case is none). Which
+# action wins must come from the ordered per-pattern loop — the `.+?`
+# bridges mean a finditer over the union can consume the span holding a
+# higher-priority match, so the fused hits can't be trusted for ranking.
+ACTION_UNION = re.compile(
+    "|".join(f"(?:{pat.pattern})" for _, pat in NEED_ACTION_PATTERNS),
+    re.I,
+)
+
+# Optional fast path: rules whose pattern is a plain alternation of literal
+# tokens go into an Aho-Corasick automaton (one linear scan over the
+# haystack regardless of rule count); the true-regex rules stay compiled.
+try:
+    import ahocorasick   # pip install pyahocorasick
+except ImportError:
+    ahocorasick = None
+
+_REGEX_META = set(r"\^$.|?*+()[]{}")
+
+def _literal_tokens(pattern: str) -> List[str] | None:
+    """Return the branches of `pattern` lowercased if every one is a plain
+    substring (no regex metacharacters), else None."""
+    pat = pattern
+    if pat.startswith("(") and pat.endswith(")"):
+        depth = 0
+        for i, ch in enumerate(pat):
+            depth += ch == "("
+            depth -= ch == ")"
+            if depth == 0 and i < len(pat) - 1:
+                break
+        else:
+            pat = pat[1:-1]
+    branches = pat.split("|")
+    if any(not b or set(b) & _REGEX_META for b in branches):
+        return None
+    return [b.lower() for b in branches]
+
+# Literal prefilter: for every alternation branch of every rule, the
+# longest metachar-free run is a substring any match must contain. If none
+# of these triggers occur in the haystack, no rule can match and
+# categorise() can skip the regex/automaton scan entirely —
+# str.__contains__ is a C-level memmem, far cheaper than the regex engine.
+# Only worthwhile if every trigger is selective: a 1-2 char trigger (`m`
+# from `m[ãa]e`, `or` from `realt(y|or)`) appears in nearly any sender
+# address, so the short-circuit would never fire and every message would
+# pay the trigger scan on top of the real one. The prefilter therefore
+# disables itself unless all triggers are ≥3 chars — which, with the
+# current ruleset, keeps it off.
+def _rule_triggers(pattern: str) -> List[str]:
+    """Longest literal run per naive alternation branch, lowercased.
+    Character classes are treated as separators so e.g. `m[ãa]e` yields
+    'm', a substring every match really contains."""
+    trigs: List[str] = []
+    for branch in pattern.split("|"):
+        branch = re.sub(r"\[[^\]]*\]", "\x00", branch)
+        frags = [f for f in re.split(r"(?:\\.|[\^$.?*+()\x00{}])+", branch) if f]
+        if not frags:
+            return []
+        trigs.append(max(frags, key=len).lower())
+    return trigs
+
+_ALL_TRIGGERS: Tuple[str, ...] = ()
+_PREFILTER_OK = True
+for _, _pat in CATEGORY_RULES:
+    _trigs = _rule_triggers(_pat.pattern)
+    if not _trigs or min(len(_t) for _t in _trigs) < 3:
+        # no fixed substring, or a trigger too short to be selective
+        _PREFILTER_OK = False
+        break
+    _ALL_TRIGGERS += tuple(_trigs)
+_ALL_TRIGGERS = tuple(dict.fromkeys(_ALL_TRIGGERS))
+
+_CAT_AUTOMATON = None
+_CAT_REGEX_RULES: List[Tuple[int, str, re.Pattern[str]]] = []
+if ahocorasick is not None:
+    _CAT_AUTOMATON = ahocorasick.Automaton()
+    for _prio, (_cat, _pat) in enumerate(CATEGORY_RULES):
+        _tokens = _literal_tokens(_pat.pattern)
+        if _tokens is None:
+            _CAT_REGEX_RULES.append((_prio, _cat, _pat))
+        else:
+            for _tok in _tokens:
+                _CAT_AUTOMATON.add_word(_tok, (_prio, _cat))
+    _CAT_AUTOMATON.make_automaton()
+
+def _strip_tags(txt: str) -> str:
+    """HTML → plain text. Uses libxml2's text_content() when lxml is
+    available (handles entities, scripts and broken markup); falls back to
+    regex stripping plus entity unescape."""
+    if lxml_html is not None:
+        try:
+            return lxml_html.fromstring(txt).text_content()
+        except Exception:
+            pass
+    return html.unescape(_TAG_RE.sub(" ", txt))
+
+def _shorten(s: str, width: int) -> str:
+    """Cheap textwrap.shorten stand-in: one slice plus a word-boundary trim
+    instead of tokenizing the whole (possibly huge) body."""
+    if len(s) <= width:
+        return s
+    return s[:width].rsplit(" ", 1)[0] + " …"
+
 # ─── HELPER FUNCTIONS ────────────────────────────────────────────────────
 def _load_creds_from_json_blob(blob: str) -> Credentials:
     """
     Accepts a JSON string representing an "authorized_user" credential and
     returns a google.oauth2.credentials.Credentials with SCOPES applied.
     """
-    data = json.loads(blob)
+    data = _json.loads(blob)
     # Allow both "scopes" (string) and "scope" (compat)
     scopes = data.get("scopes") or data.get("scope")
     if isinstance(scopes, str):
@@ -99,13 +237,24 @@ def _load_creds_from_json_blob(blob: str) -> Credentials:
             raise ValueError(f"token.json missing required field: {k}")
     return Credentials.from_authorized_user_info(data, SCOPES)
 
-def _maybe_refresh(creds: Credentials) -> Credentials:
+def _save_token(creds: Credentials) -> None:
+    """Write token.json atomically (temp file + rename) so a crash mid-write
+    can't leave a truncated token that forces the slow OAuth dance."""
+    try:
+        with tempfile.NamedTemporaryFile("w", dir=".", delete=False, encoding="utf-8") as tf:
+            tf.write(creds.to_json())
+        os.replace(tf.name, "token.json")
+    except Exception:
+        pass
+
+def _maybe_refresh(creds: Credentials) -> Tuple[Credentials, bool]:
+    """Returns (creds, True if a refresh actually happened)."""
     if creds.valid:
-        return creds
+        return creds, False
     if creds.expired and creds.refresh_token:
         try:
             creds.refresh(Request())
-            return creds
+            return creds, True
         except RefreshError as e:
             msg = str(e)
             # Common cases explained:
@@ -132,19 +281,16 @@ def get_credentials() -> Credentials:
     """
     token_env = os.getenv("TOKEN_JSON", "").strip()
     if token_env:
-        creds = _load_creds_from_json_blob(token_env)
-        return _maybe_refresh(creds)
+        creds, _ = _maybe_refresh(_load_creds_from_json_blob(token_env))
+        return creds
 
     if os.path.exists("token.json"):
         with open("token.json", "r", encoding="utf-8") as f:
-            creds = Credentials.from_authorized_user_info(json.load(f), SCOPES)
-        creds = _maybe_refresh(creds)
-        # write back refreshed token for local runs
-        try:
-            with open("token.json", "w", encoding="utf-8") as f:
-                f.write(creds.to_json())
-        except Exception:
-            pass
+            creds = Credentials.from_authorized_user_info(_json.loads(f.read()), SCOPES)
+        creds, refreshed = _maybe_refresh(creds)
+        # write back the token for local runs, but only when it changed
+        if refreshed:
+            _save_token(creds)
         return creds
 
     # Only fall back to interactive flow locally
@@ -170,25 +316,83 @@ def get_credentials() -> Credentials:
         SCOPES,
     )
     creds = flow.run_local_server(port=8765, prompt="consent")
-    try:
-        with open("token.json", "w", encoding="utf-8") as f:
-            f.write(creds.to_json())
-    except Exception:
-        pass
+    _save_token(creds)
     return creds
 
 def list_msg_ids(svc, after_ts: int) -> List[str]:
     q = f"after:{after_ts} -category:promotions -category:social -in:spam"
-    ids, resp = [], svc.users().messages().list(userId="me", q=q).execute()
+    # maxResults=500 is the Gmail cap; the default 100/page costs 5x the round trips
+    ids, resp = [], svc.users().messages().list(userId="me", q=q, maxResults=500).execute()
     ids += [m["id"] for m in resp.get("messages", [])]
     while resp.get("nextPageToken"):
         resp = svc.users().messages().list(
-            userId="me", q=q, pageToken=resp["nextPageToken"]).execute()
+            userId="me", q=q, maxResults=500, pageToken=resp["nextPageToken"]).execute()
         ids += [m["id"] for m in resp.get("messages", [])]
     return ids
 
+_META_HEADERS = ["Subject", "From", "Date"]
+
 def fetch_full(svc, msg_id: str) -> Dict[str, Any]:
-    return svc.users().messages().get(userId="me", id=msg_id, format="full").execute()
+    return svc.users().messages().get(userId="me", id=msg_id, format="raw").execute()
+
+def _fetch_threaded(creds, msg_ids: List[str], **get_kwargs) -> Dict[str, Dict[str, Any]]:
+    """Thread-pool fallback for when BatchHttpRequest is rejected. httplib2
+    is not thread-safe, so each worker lazily builds its own service."""
+    from googleapiclient.discovery import build
+    local = threading.local()
+
+    def _get(mid: str):
+        svc = getattr(local, "svc", None)
+        if svc is None:
+            svc = local.svc = build("gmail", "v1", credentials=creds, cache_discovery=False, static_discovery=True)
+        try:
+            return mid, svc.users().messages().get(userId="me", id=mid, **get_kwargs).execute()
+        except HttpError as err:
+            print(f"⚠️ could not fetch message {mid}: {err}")
+            return mid, None
+
+    with ThreadPoolExecutor(max_workers=10) as ex:
+        return {mid: resp for mid, resp in ex.map(_get, msg_ids) if resp is not None}
+
+def fetch_batch(svc, msg_ids: List[str], creds=None, **get_kwargs) -> Dict[str, Dict[str, Any]]:
+    """
+    Fetch many messages with BatchHttpRequest (100 gets per round trip)
+    instead of one HTTP call per id. Returns {msg_id: response}. If the
+    batch endpoint itself errors and creds are given, falls back to a
+    thread pool of plain gets.
+    """
+    fulls: Dict[str, Dict[str, Any]] = {}
+    failed: List[str] = []
+
+    def _cb(request_id, response, exception):
+        if exception is not None:
+            failed.append(request_id)
+        else:
+            fulls[request_id] = response
+
+    try:
+        for i in range(0, len(msg_ids), 100):
+            batch = svc.new_batch_http_request(callback=_cb)
+            for mid in msg_ids[i:i + 100]:
+                batch.add(svc.users().messages().get(userId="me", id=mid, **get_kwargs),
+                          request_id=mid)
+            batch.execute()
+    except HttpError as err:
+        if creds is None:
+            raise
+        print(f"⚠️ batch fetch rejected ({err}); falling back to thread pool")
+        missing = [mid for mid in msg_ids if mid not in fulls]
+        fulls.update(_fetch_threaded(creds, missing, **get_kwargs))
+        return fulls
+
+    # Retry stragglers one by one so a single bad id doesn't sink the digest
+    for mid in failed:
+        try:
+            fulls[mid] = svc.users().messages().get(
+                userId="me", id=mid, **get_kwargs).execute()
+        except HttpError as err:
+            print(f"⚠️ could not fetch message {mid}: {err}")
+    return fulls
 
 def meta_from_full(full: Dict[str, Any]) -> Dict[str, Any]:
     hdr = {h["name"].lower(): h["value"] for h in full["payload"]["headers"]}
@@ -199,109 +403,182 @@ def meta_from_full(full: Dict[str, Any]) -> Dict[str, Any]:
         "date": hdr.get("date", ""),
         "important": "IMPORTANT" in full.get("labelIds", []),
         "snippet": html.unescape(full.get("snippet", "")),
-        "attachments": collect_attachments(full),
     }
 
-def collect_attachments(full: Dict[str, Any]) -> List[str]:
+def walk_payload(full: Dict[str, Any]) -> Tuple[List[str], str]:
+    """Parse a format="raw" Gmail response with the C-accelerated stdlib
+    email parser; one pass collects attachment filenames and decoded
+    text/plain + text/html content (tags stripped)."""
+    raw = full.get("raw")
+    if not raw:
+        return [], ""
+    msg = BytesParser(policy=policy.default).parsebytes(base64.urlsafe_b64decode(raw))
     files: List[str] = []
-    def walk(parts):
-        for p in parts:
-            if fname := p.get("filename"):
-                files.append(fname)
-            if "parts" in p:
-                walk(p["parts"])
-    walk(full.get("payload", {}).get("parts", []))
-    return files
-
-def extract_plain_text(full: Dict[str, Any]) -> str:
-    """Walks the Gmail message parts and returns all text/plain or text/html content decoded."""
-    def walk(parts):
-        texts: List[str] = []
-        for p in parts:
-            ct = p.get("mimeType", "")
-            data = p.get("body", {}).get("data")
-            if data and ct in ("text/plain", "text/html"):
-                txt = base64.urlsafe_b64decode(data).decode("utf-8", "ignore")
-                if ct == "text/html":
-                    txt = re.sub(r"<[^>]+>", " ", txt)
-                texts.append(txt)
-            if "parts" in p:
-                texts.extend(walk(p["parts"]))
-        return texts
-    return "\n".join(walk(full.get("payload", {}).get("parts", [])))
+    plain_parts: List[str] = []
+    html_parts: List[str] = []
+    plain_len = html_len = 0
+    for part in msg.walk():
+        if fname := part.get_filename():
+            files.append(fname)
+        ct = part.get_content_type()
+        # The summariser truncates to 1200 chars, so stop decoding text once
+        # we hold a few times that — 200 KB newsletters would otherwise be
+        # decoded and stripped just to be thrown away. Attachment names keep
+        # being collected from the rest of the walk.
+        if ct == "text/plain" and plain_len < BODY_CHAR_BUDGET:
+            try:
+                txt = part.get_content()
+            except Exception:
+                continue
+            plain_parts.append(txt)
+            plain_len += len(txt)
+        elif ct == "text/html" and not plain_parts and html_len < BODY_CHAR_BUDGET:
+            try:
+                txt = part.get_content()
+            except Exception:
+                continue
+            html_parts.append(txt)
+            html_len += len(txt)
+    # multipart/alternative carries the same content twice; prefer the
+    # text/plain siblings and only pay for tag stripping when there aren't any
+    if plain_parts:
+        return files, "\n".join(plain_parts)
+    return files, "\n".join(_strip_tags(t) for t in html_parts)
 
 # ─── SUMMARISER ──────────────────────────────────────────────────────────
-def summarise(subject: str, text: str) -> str:
+async def summarise_async(client: "openai.AsyncOpenAI", subject: str, text: str) -> str:
+    import openai
     if not text:
         return "Summary not available."
+    # Short transactional mails don't need GPT — the text itself (usually
+    # the snippet) is already the summary.
+    if len(text) < 300:
+        return _shorten(text, 180).strip() or "Summary not available."
     sys_prompt = "Summarise the email in 1 paragraph. **Do not** repeat the subject."
-    try:
-        resp = openai.chat.completions.create(
-            model=MODEL,
-            messages=[
-                {"role": "system", "content": sys_prompt},
-                {"role": "user",   "content": textwrap.shorten(text, width=1200, placeholder=" …")},
-            ],
-            max_tokens=SUMMARY_TOKENS,
-            temperature=0.2,
-        )
-        summary = resp.choices[0].message.content.strip()
-    except Exception as e:
-        print(f"❌ summarise() failed for subject={subject!r}: {e}")
-        raise
+    delay = 1
+    for attempt in range(4):
+        try:
+            resp = await client.chat.completions.create(
+                model=MODEL,
+                messages=[
+                    {"role": "system", "content": sys_prompt},
+                    {"role": "user",   "content": _shorten(text, 1200)},
+                ],
+                max_tokens=SUMMARY_TOKENS,
+                temperature=0.2,
+            )
+            summary = resp.choices[0].message.content.strip()
+            break
+        except openai.RateLimitError:
+            if attempt == 3:
+                raise
+            await asyncio.sleep(delay)   # back off 1s, 2s, 4s
+            delay *= 2
+        except Exception as e:
+            print(f"❌ summarise_async() failed for subject={subject!r}: {e}")
+            raise
 
-    subj_norm = re.sub(r"\W+", "", subject.lower())
-    summ_norm = re.sub(r"\W+", "", summary.lower())
+    subj_norm = _NON_WORD.sub("", subject.lower())
+    summ_norm = _NON_WORD.sub("", summary.lower())
     if subj_norm and summ_norm.startswith(subj_norm[:30]):
-        summary = textwrap.shorten(text, width=180, placeholder=" …") or "Summary not available."
+        summary = _shorten(text, 180).strip() or "Summary not available."
     return summary
 
+async def _summarise_all(pairs: List[Tuple[str, str]]) -> List[str]:
+    """Run summarise_async over all (subject, text) pairs concurrently."""
+    import openai   # AsyncOpenAI reads OPENAI_API_KEY from the environment
+    client = openai.AsyncOpenAI()
+    sem = asyncio.Semaphore(10)   # stay under the OpenAI rate limit
+
+    async def one(subject: str, text: str) -> str:
+        async with sem:
+            return await summarise_async(client, subject, text)
+
+    try:
+        return list(await asyncio.gather(*(one(s, t) for s, t in pairs)))
+    finally:
+        await client.close()
+
 # ─── CATEGORY & FOLLOW-UP ────────────────────────────────────────────────
 def categorise(meta: Dict[str, Any]) -> str:
     hay = f"{meta['subject']} {meta['from']}".lower()
-    for cat, pat in CATEGORY_RULES:
-        if pat.search(hay):
-            return cat
-    return "Other"
+    if _PREFILTER_OK and not any(t in hay for t in _ALL_TRIGGERS):
+        return DEFAULT_CATEGORY
+    if _CAT_AUTOMATON is not None:
+        best: Tuple[int, str] | None = None
+        for _, hit in _CAT_AUTOMATON.iter(hay):
+            if best is None or hit < best:
+                best = hit
+        for prio, cat, pat in _CAT_REGEX_RULES:   # ordered by priority
+            if best is not None and best[0] < prio:
+                break
+            if pat.search(hay):
+                best = (prio, cat)
+                break
+        return best[1] if best else DEFAULT_CATEGORY
+    best_m = min(CAT_UNION.finditer(hay),
+                 key=lambda m: _GROUP_PRIO[m.lastgroup], default=None)
+    return _GROUP_TO_CAT[best_m.lastgroup] if best_m else DEFAULT_CATEGORY
 
 def detect_followup(meta: Dict[str, Any], summary: str) -> Tuple[bool, str | None]:
     hay = f"{meta['subject']} {summary} {meta['snippet']}"
-    for act, pat in NEED_ACTION_PATTERNS:
-        if pat.search(hay):
-            return True, act
-    if re.search(r"^re:\s", meta["subject"], re.I):
+    if ACTION_UNION.search(hay):
+        for act, pat in NEED_ACTION_PATTERNS:
+            if pat.search(hay):
+                return True, act
+    if _RE_PREFIX.search(meta["subject"]):
         return True, "Send reply"
     return False, None
 
 # ─── HTML DIGEST BUILDER ────────────────────────────────────────────────
 CARD_CSS = "margin:8px 0;padding:12px;border:1px solid #e0e0e0;border-radius:8px;"
 
+# Outer page shell, parsed once at import; main() fills it with one
+# substitute() pass instead of re-evaluating a multi-KB f-string.
+_DIGEST_TMPL = string.Template("""
+    <html><body style="font-family:Helvetica,Arial;background:#f6f8fa;padding:24px;">
+      <div style="max-width:680px;margin:auto;background:#fff;padding:24px;border-radius:12px;">
+        <h2 style="margin-top:0">📬 Gmail Daily Digest <span style="font-size:14px;color:#888">— $today</span></h2>
+        <h3>📊 Overview</h3>
+        <ul><li>Total: $total | Important: $important | Attachments: $attach</li></ul>
+        $body
+        <h3>📝 Action Items</h3>
+        <ul>$action_items</ul>
+        <h3>📎 Attachments</h3>
+        <ul>$attachments</ul>
+        <h3>🤖 Suggestions</h3>
+        <ul>$suggestions</ul>
+      </div></body></html>""")
+
 def build_digest(groups: Dict[str, List[Dict[str, Any]]]):
-    sections, attachments, followups = [], [], []
+    # One flat list for the whole digest, joined once at the end — avoids
+    # per-section intermediate strings.
+    parts: List[str] = []
+    emit = parts.append
+    attachments, followups = [], []
     ref_no = 1
     for cat, items in groups.items():
         if not items:
             continue
-        seg = [f"<h3>{cat}</h3>"]
+        emit(f"<h3>{cat}</h3>")
         for m in items:
             ref = f"[{ref_no:02d}]"
             try:
-                date_fmt = dt.datetime.strptime(m["date"][:25], "%a, %d %b %Y %H:%M:%S").strftime("%d/%m/%Y")
-            except Exception:
+                date_fmt = parsedate_to_datetime(m["date"]).strftime("%d/%m/%Y")
+            except (TypeError, ValueError):
                 date_fmt = ""
-            header = f"{ref} {html.escape(m['subject'])} — {html.escape(m['from'])} {f'({date_fmt})' if date_fmt else ''}"
-            seg.append(
-                f'<div style="{CARD_CSS}"><div style="font-weight:bold;">{header}</div>'
-                f'<div style="color:#555;margin-top:4px;">{html.escape(m["summary"])}</div></div>'
-            )
+            emit(f'<div style="{CARD_CSS}"><div style="font-weight:bold;">')
+            emit(f"{ref} {m['subject_html']} — {m['from_html']} {f'({date_fmt})' if date_fmt else ''}")
+            emit('</div><div style="color:#555;margin-top:4px;">')
+            emit(m["summary_html"])
+            emit("</div></div>")
             for f in m["attachments"]:
-                attachments.append((f, ref, m["from"]))
+                attachments.append((f, ref, m["from_html"]))
             need_fu, act = detect_followup(m, m["summary"])
             if need_fu and act:
-                followups.append({"ref": ref, "action": act, "subject": m["subject"]})
+                followups.append({"ref": ref, "action": act, "subject_html": m["subject_html"]})
             ref_no += 1
-        sections.append("\n".join(seg))
-    return "\n".join(sections), attachments, followups
+    return "".join(parts), attachments, followups
 
 def build_suggestions(groups: Dict[str, List[Dict[str, Any]]], followups, attach_n: int) -> List[str]:
     s: List[str] = []
@@ -319,19 +596,33 @@ def build_suggestions(groups: Dict[str, List[Dict[str, Any]]], followups, attach
 
 # ─── NOTION LOGGER ───────────────────────────────────────────────────────
 def strip_html(ht: str) -> str:
-    return html.unescape(re.sub(r"<[^>]+>", "", ht)).strip()
+    return _strip_tags(ht).strip()
 
-def add_to_notion(html_digest: str) -> None:
-    if not (NOTION_SECRET and NOTION_DB_ID):
+def _notion_call(fn, **kwargs):
+    """Call a Notion endpoint, retrying conflicts/rate limits (409/429)
+    with 1s/2s/4s backoff."""
+    delay = 1
+    for attempt in range(4):
+        try:
+            return fn(**kwargs)
+        except Exception as e:
+            if getattr(e, "status", None) in (409, 429) and attempt < 3:
+                time.sleep(delay)
+                delay *= 2
+                continue
+            raise
+
+def add_to_notion(client: "Client | None", html_digest: str) -> None:
+    if client is None:
         return
-    
+
     plain_digest = strip_html(html_digest)
 
     # Also prepare Notion blocks for detailed content
     lines = [ln for ln in plain_digest.splitlines() if ln.strip()]
     blocks: List[Dict[str, Any]] = []
     for ln in lines:
-        if re.match(r"^[📊📝📎🤖]|^[A-Z][a-z]+", ln):
+        if _HEADING_RE.match(ln):
             blocks.append({
                 "object": "block",
                 "type": "heading_2",
@@ -347,40 +638,103 @@ def add_to_notion(html_digest: str) -> None:
                     }
                 })
 
-    Client(auth=NOTION_SECRET).pages.create(
+    # Notion caps children at 100 per request; append the rest in
+    # 100-block chunks instead of silently truncating.
+    page = _notion_call(
+        client.pages.create,
         parent={"database_id": NOTION_DB_ID},
         properties={
             "Name": {"title": [{"text": {"content": f"Digest {dt.date.today()}"}}]},
             "Digest": {"rich_text": [{"text": {"content": plain_digest}}]}
         },
-        children=blocks[:50]  # optional: limit to avoid API max
+        children=blocks[:100],
     )
+    for i in range(100, len(blocks), 100):
+        _notion_call(client.blocks.children.append,
+                     block_id=page["id"], children=blocks[i:i + 100])
 
 # ─── MAIN ────────────────────────────────────────────────────────────────
 def main() -> None:
+    from googleapiclient.discovery import build
+    from notion_client import Client
+
     creds = get_credentials()
-    svc = build("gmail", "v1", credentials=creds)
+    svc = build("gmail", "v1", credentials=creds, cache_discovery=False, static_discovery=True)
+    # One Notion client for the whole run: the HTTP session (and its TLS
+    # handshake) is reused across pages.create / children.append calls.
+    notion = Client(auth=NOTION_SECRET) if (NOTION_SECRET and NOTION_DB_ID) else None
 
     after_ts = int(time.time()) - WINDOW_SECONDS
     msg_ids = list_msg_ids(svc, after_ts)
 
+    # Phase 1: headers + snippet only — enough to dedupe and categorise
+    # without pulling full MIME payloads for messages we then drop.
+    meta_responses = fetch_batch(svc, msg_ids, creds=creds,
+                                 format="metadata", metadataHeaders=_META_HEADERS)
+
     metas, seen = [], set()
     for mid in msg_ids:
-        full = fetch_full(svc, mid)
-        meta = meta_from_full(full)
+        resp = meta_responses.get(mid)
+        if resp is None:
+            continue
+        meta = meta_from_full(resp)
         # Skip the digests I send myself
         if meta["subject"].startswith("📬 Gmail Daily Digest"):
             continue
-        if meta["subject"] in seen:
+        # Dedupe on normalized subject + sender, not raw subject, so two
+        # unrelated "Re: question" mails don't collapse into one while
+        # "Re: Foo" / "RE:  Foo  " / "Fwd: Foo" from the same sender do.
+        norm = _NON_WORD.sub("", meta["subject"].lower())
+        key = hash((norm.removeprefix("re").removeprefix("fwd")[:64], meta["from"]))
+        if key in seen:
             continue
-        seen.add(meta["subject"])
-        body_text = extract_plain_text(full) or meta["snippet"] or meta["subject"]
-        meta["summary"] = summarise(meta["subject"], body_text)
+        seen.add(key)
+        meta["category"] = categorise(meta)
         metas.append(meta)
 
+    # Phase 2: raw RFC 822 bodies only for the messages that made the cut.
+    fulls = fetch_batch(svc, [m["id"] for m in metas], creds=creds, format="raw")
+    for meta in metas:
+        meta["attachments"], body_text = walk_payload(fulls.get(meta["id"], {}))
+        meta["body_text"] = body_text or meta["snippet"] or meta["subject"]
+
+    # Persistent cache keyed by Gmail message id: a re-run inside the 24 h
+    # window (crash recovery, manual retry) skips the OpenAI calls entirely.
+    with shelve.open(".digest_cache") as cache:
+        # Cache hits by message id (same mail, re-run) or by content hash
+        # (same body under a fresh id: newsletter re-sends, thread echoes).
+        pending = []
+        for m in metas:
+            m["body_sha"] = "sha1:" + hashlib.sha1(
+                f"{m['subject']}\n{m['body_text']}".encode()).hexdigest()
+            cached = cache.get(m["id"]) or cache.get(m["body_sha"])
+            if cached is not None:
+                m["summary"] = cached
+            else:
+                pending.append(m)
+        # Identical (subject, body) pairs within one run are summarised once
+        # and the result fanned out.
+        by_hash: Dict[str, List[Dict[str, Any]]] = {}
+        for m in pending:
+            by_hash.setdefault(m["body_sha"], []).append(m)
+        unique = [dupes[0] for dupes in by_hash.values()]
+        summaries = asyncio.run(_summarise_all([(m["subject"], m["body_text"]) for m in unique]))
+        for dupes, summary in zip(by_hash.values(), summaries):
+            for meta in dupes:
+                meta["summary"] = summary
+                cache[meta["id"]] = summary
+            cache[dupes[0]["body_sha"]] = summary
+
+    # Escape once per message; the digest body and the action/attachment
+    # lists all reuse these.
+    for m in metas:
+        m["subject_html"] = html.escape(m["subject"])
+        m["from_html"] = html.escape(m["from"])
+        m["summary_html"] = html.escape(m["summary"])
+
     groups: Dict[str, List[Dict[str, Any]]] = {}
     for m in metas:
-        groups.setdefault(categorise(m), []).append(m)
+        groups.setdefault(m["category"], []).append(m)
 
     body_html, attachments, followups = build_digest(groups)
 
@@ -392,35 +746,41 @@ def main() -> None:
     sugg = build_suggestions(groups, followups, len(attachments))
 
     today = dt.datetime.now().strftime("%d/%m/%Y")
-    action_items_html = ("".join(f"<li>[Action: {fu['action']}] {fu['ref']} {html.escape(fu['subject'])}</li>"
+    action_items_html = ("".join(f"<li>[Action: {fu['action']}] {fu['ref']} {fu['subject_html']}</li>"
                                  for fu in followups) or "<li>None</li>")
-    attachments_html = ("".join(f"<li>{html.escape(f)} — {r} — {html.escape(s)}</li>"
+    attachments_html = ("".join(f"<li>{html.escape(f)} — {r} — {s}</li>"
                                 for f, r, s in attachments) or "<li>None</li>")
     suggestions_html = "".join(f"<li>{html.escape(x)}</li>" for x in sugg)
 
-    html_digest = f"""
-    <html><body style="font-family:Helvetica,Arial;background:#f6f8fa;padding:24px;">
-      <div style="max-width:680px;margin:auto;background:#fff;padding:24px;border-radius:12px;">
-        <h2 style="margin-top:0">📬 Gmail Daily Digest <span style="font-size:14px;color:#888">— {today}</span></h2>
-        <h3>📊 Overview</h3>
-        <ul><li>Total: {overview['total']} | Important: {overview['important']} | Attachments: {overview['attach']}</li></ul>
-        {body_html}
-        <h3>📝 Action Items</h3>
-        <ul>{action_items_html}</ul>
-        <h3>📎 Attachments</h3>
-        <ul>{attachments_html}</ul>
-        <h3>🤖 Suggestions</h3>
-        <ul>{suggestions_html}</ul>
-      </div></body></html>"""
+    html_digest = _DIGEST_TMPL.substitute(
+        today=today,
+        total=overview["total"],
+        important=overview["important"],
+        attach=overview["attach"],
+        body=body_html,
+        action_items=action_items_html,
+        attachments=attachments_html,
+        suggestions=suggestions_html,
+    )
 
     msg = MIMEMultipart("alternative")
     msg["Subject"] = f"📬 Gmail Daily Digest — {today}"
     msg["From"] = msg["To"] = SEND_TO
     msg.attach(MIMEText(html_digest, "html", "utf-8"))
     raw = base64.urlsafe_b64encode(msg.as_bytes()).decode()
-    svc.users().messages().send(userId="me", body={"raw": raw}).execute()
 
-    add_to_notion(html_digest)
+    # The Gmail send and the Notion write are independent; overlap their
+    # latencies instead of paying them back to back.
+    def _send():
+        svc.users().messages().send(userId="me", body={"raw": raw}).execute()
+
+    async def _finish():
+        await asyncio.gather(
+            asyncio.to_thread(_send),
+            asyncio.to_thread(add_to_notion, notion, html_digest),
+        )
+
+    asyncio.run(_finish())
     print("✅ Improved digest emailed & logged to Notion!")
 
 if __name__ == "__main__":